@@ -30,7 +30,10 @@ if os.name == "nt":
 
 import scripts.project_manager as ymlRW
 from scripts.Scanner_Controller import ScannerController
-from processStack import getThreads, stack_images, mask_images
+from processStack import get_num_workers, stack_images, mask_images, stacking_jobs
+from scripts.focus_stacking import StreamingStackThread
+from scripts.alignment_cache import get_alignment_cache
+from scripts.frame_index import FrameIndex
 from scripts.write_meta_data import write_exif_to_img, get_default_values
 
 
@@ -404,6 +407,10 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
         self.stackImages = False
         self.thresholdImages = False
         self.stackFocusThreshold = 10.0
+        self.stackFocusMode = "absolute"
+        self.stackFocusFraction = 0.5
+        self.stackingMethod = "default"
+        self.stackDepthMap = False
         self.stackDisplayFocus = False
         self.stackSharpen = False
         self.ui.checkBox_stackImages.stateChanged.connect(self.enableStacking)
@@ -441,7 +448,7 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
         self.ui.action_lightMode.triggered.connect(self.lightMode)
 
         # stack and mask images
-        self.maxStackThreads = max(min([int(getThreads() / 6), 2]), 1)
+        self.maxStackThreads = max(min([int(get_num_workers() / 6), 2]), 1)
         # run no more than 3 stacking threads simultaneously but no less than 1
         self.postScanStacking = False
         self.activeThreads = 0
@@ -450,6 +457,8 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
         self.stackQueue = queue.Queue()
         # FIX: lock to protect activeThreads counter from concurrent read/write corruption (issue #31)
         self._threadCountLock = threading.Lock()
+        # streaming stacking: maps each captured image path to the stacker of its stack, until it is written
+        self.streamingSlices = {}
 
     """
     Stepper Control
@@ -936,6 +945,10 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
             config = ymlRW.read_config_file(config_location)
 
             focus_threshold = config["stacking"]["threshold"]
+            focus_mode = config["stacking"].get("focus_mode", "absolute")
+            focus_fraction = config["stacking"].get("focus_fraction", 0.5)
+            stacking_method = config["stacking"].get("stacking_method", "default")
+            depth_map = config["stacking"].get("depth_map", False)
             sharpen = config["stacking"]["additional_sharpening"]
             exif = config["exif_data"]
             mask_images_check = config["masking"]["mask_images"]
@@ -945,23 +958,14 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
             mask_artifact_size_white = config["masking"]["min_artifact_size_white"]
 
 
-            stacks = []
-            stack = []
-            prev_xy = ""
-            for i,file in enumerate(os.listdir(raw_folder_loc)):
-                xy_pos = file[:-10]
-                if xy_pos != prev_xy and i != 0:
-                    stacks.append(stack)    
-                    stack = []
+            stacks = [[str(path) for path in stack_paths]
+                      for _, stack_paths in FrameIndex.from_folder(raw_folder_loc).stacks(min_frames=2)]
 
-
-                stack.append(str(Path(raw_folder_loc).joinpath(file)))
-                prev_xy = xy_pos
-            
             for stack in stacks:
                 try:
                     stacked_output = stack_images(input_paths=stack, check_focus = self.thresholdImages, threshold=focus_threshold,
-                                                sharpen=sharpen)
+                                                sharpen=sharpen, focus_mode=focus_mode, focus_fraction=focus_fraction,
+                                                stacking_method=stacking_method, depth_map=depth_map)
 
                     # FIX: guard against empty return from stack_images (issue #31)
                     if not stacked_output:
@@ -1067,6 +1071,11 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                 self.stackFocusThreshold = config["stacking"]["threshold"]
                 self.ui.doubleSpinBox_threshold.setValue(self.stackFocusThreshold)
 
+                self.stackFocusMode = config["stacking"].get("focus_mode", "absolute")
+                self.stackFocusFraction = config["stacking"].get("focus_fraction", 0.5)
+                self.stackingMethod = config["stacking"].get("stacking_method", "default")
+                self.stackDepthMap = config["stacking"].get("depth_map", False)
+
                 self.stackDisplayFocus = config["stacking"]["display_focus_check"]
                 self.stackSharpen = config["stacking"]["additional_sharpening"]
 
@@ -1161,8 +1170,12 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                                        'z_max': self.ui.doubleSpinBox_zMax.value(),
                                        'z_step': self.ui.doubleSpinBox_zStep.value()},
                   'stacking': {'stack_images': self.ui.checkBox_stackImages.isChecked(),
+                               'stacking_method': self.stackingMethod,
                                'threshold_images': self.ui.checkBox_threshold.isChecked(),
                                'threshold': self.ui.doubleSpinBox_threshold.value(),
+                               'focus_mode': self.stackFocusMode,
+                               'focus_fraction': self.stackFocusFraction,
+                               'depth_map': self.stackDepthMap,
                                'display_focus_check': self.stackDisplayFocus,
                                'additional_sharpening': self.stackSharpen},
                   'masking': {'mask_images': self.ui.checkBox_maskImages.isChecked(),
@@ -1573,6 +1586,17 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
         self.images_to_take = len(self.scanner.scan_pos[0]) * len(self.scanner.scan_pos[1]) * len(
             self.scanner.scan_pos[2])
         print(self.scanner.scan_pos)
+
+        # streamed slices are fused in the order they are captured, so they are captured furthest-first (descending
+        # focus step), the order every other stacking path uses (see FrameIndex.stacks). Depth map indices and the
+        # alignment cache pairs then match those of stacks processed after the scan
+        streaming = self.stackImages and self.stackingMethod == "streaming"
+        focus_positions = self.scanner.scan_pos[2]
+        if streaming:
+            focus_positions = focus_positions[::-1]
+            self.log_info("Streaming stacking fuses every captured slice: the focus check is skipped and the stacks "
+                          "are not recorded in the postprocessing manifest")
+
         for posX in self.scanner.scan_pos[0]:
 
             self.scanner.moveToPosition(0, posX)
@@ -1586,9 +1610,23 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                 # create list of images associated with each stack for simultaneous processing
                 stackName = []
 
-                for posZ in self.scanner.scan_pos[2]:
+                # when streaming, slices are fused as soon as they are written instead of after the full stack
+                streamingStack = None
+                if streaming:
+                    streamingStack = StreamingStackThread(
+                        output_path=str(self.output_location_folder.joinpath(
+                            "stacked", "_x_" + self.scanner.correctName(posX) +
+                                       "_y_" + self.scanner.correctName(posY) + "_.tif")),
+                        num_slices=len(self.scanner.scan_pos[2]),
+                        alignment_cache=get_alignment_cache(self.output_location_folder),
+                        depth_map=self.stackDepthMap)
+                    streamingStack.start()
+
+                for posZ in focus_positions:
                     save_time = time.time()
                     if self.abortScan:
+                        if streamingStack is not None:
+                            streamingStack.cancel()
                         return
 
                     self.scanner.moveToPosition(2, posZ)
@@ -1601,6 +1639,9 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                     stackName.append(img_name)
 
                     if self.camera_type == "FLIR":
+                        if streamingStack is not None:
+                            # handed to the stacker once the image has been written (see checkActiveStackThreads)
+                            self.streamingSlices[img_name] = streamingStack
                         captured_image = self.cam.capture_image(img_name, return_image=True)
                         self.FLIR_image_queue.append([captured_image, img_name])
                         # wait for the camera to capture the image before moving further
@@ -1608,6 +1649,10 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                         
                     if self.camera_type == "DSLR":
                         self.cam.capture_image(img_name)
+                        if streamingStack is not None:
+                            # capture_image returns before the file is written, the stacker waits until the file
+                            # has stopped growing (and a JPEG ends with its EOI marker) before reading it
+                            streamingStack.put(img_name)
                         # wait for the camera to capture the image before moving further
                         time.sleep(0.2)
                     self.images_taken += 1
@@ -1622,7 +1667,11 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                     time.sleep(2)
 
 
-                self.stackQueue.put(stackName)
+                if streamingStack is not None:
+                    worker = Worker(self.finishStreamingStack, streamingStack)
+                    self.threadpool.start(worker)
+                else:
+                    self.stackQueue.put(stackName)
                 self.scanner.completedStacks += 1
             self.scanner.completedRotations += 1
         # return to default position
@@ -1675,14 +1724,20 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
                     temp_FLIR_image_queue = self.FLIR_image_queue.copy()
                     for img in temp_FLIR_image_queue:
                         # write image to drive with pre-determined name
+                        streamingStack = self.streamingSlices.pop(img[1], None)
                         try:
                             img[0].Save(img[1])
                             print('Image saved as %s' % img[1])
                             self.saved_imgs +=1
+                            if streamingStack is not None:
+                                streamingStack.put(img[1])
                             # Release image
                         except Exception as error_save_FLIR_img:
                             print("Failed to save:", img[1])
                             print(error_save_FLIR_img)
+                            if streamingStack is not None:
+                                # let the stacker know this slice will not arrive
+                                streamingStack.put(None)
                         img[0].Release()
                         # remove entries from queue once done
                         self.FLIR_image_queue.remove(img)
@@ -1718,7 +1773,10 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
 
         try:
             stacked_output = stack_images(input_paths=stack, check_focus = self.thresholdImages, threshold=self.stackFocusThreshold,
-                                          sharpen=self.stackSharpen)
+                                          sharpen=self.stackSharpen, focus_mode=self.stackFocusMode,
+                                          focus_fraction=self.stackFocusFraction,
+                                          stacking_method=self.stackingMethod,
+                                          depth_map=self.stackDepthMap)
 
             # FIX: guard against empty return from stack_images (e.g. no usable images found)
             if not stacked_output:
@@ -1745,6 +1803,30 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
             with self._threadCountLock:
                 self.activeThreads -= 1
 
+    def finishStreamingStack(self, streamingStack, progress_callback):
+        """
+        Waits for the last slice of a streamed stack to be fused, then adds meta data and masks the result. Unlike
+        processStack.py, streamed stacks skip the focus check and are not recorded in the postprocessing manifest,
+        so re-running processStack.py on the project stacks them again
+        """
+        try:
+            output_path = streamingStack.finish()
+            if output_path is None:
+                print("WARNING: streaming stacking returned no output for", streamingStack.output_path)
+                return
+
+            write_exif_to_img(img_path=output_path, custom_exif_dict=self.exif)
+
+            if self.maskImages:
+                mask_images(input_paths=[output_path], min_rgb=self.maskThreshMin, max_rgb=self.maskThreshMax,
+                            min_bl=self.maskArtifactSizeBlack, min_wh=self.maskArtifactSizeWhite, create_cutout=True)
+
+                if self.createCutout:
+                    write_exif_to_img(img_path=str(output_path)[:-4] + '_cutout.jpg', custom_exif_dict=self.exif)
+
+        except Exception as e:
+            print(e)
+
     def closeEvent(self, event):
         # de-energise steppers, if connected
         if self.scanner_initialised:
@@ -1754,6 +1836,8 @@ class scAnt_mainWindow(QtWidgets.QMainWindow):
 
         # report the program is to be closed so threads can be exited
         self.exit_program = True
+        # stop external stacking tools that are still running
+        stacking_jobs.cancel_all()
 
         # stop the live view if currently in use
         if self.liveView:
@@ -1,6 +1,10 @@
 import os
 import numpy as np
 from pathlib import Path
+try:
+    from scripts.job_runner import JobRunner
+except ModuleNotFoundError:
+    from job_runner import JobRunner
 
 """
 00281480,         Tic T500 Stepper Motor Controller -> X-Axis (camera arm)
@@ -9,9 +13,17 @@ from pathlib import Path
 """
 
 
+# seconds after which an unresponsive ticcmd call is stopped (and retried)
+TICCMD_TIMEOUT = 10
+TICCMD_RETRIES = 2
+
+
 class ScannerController:
 
     def __init__(self):
+        # all steppers share the USB bus, so only one ticcmd call runs at a time
+        self.ticcmd_jobs = JobRunner(max_concurrent=1, timeout=TICCMD_TIMEOUT, retries=TICCMD_RETRIES)
+
         self.stepperX_ID = "00281480"
         self.stepperY_ID = "00281470"
         self.stepperZ_ID = "00282144"
@@ -76,51 +88,63 @@ class ScannerController:
 
         return step_name
 
+    def ticcmd(self, stepper_ID, *args):
+        """
+        Runs ticcmd for a single stepper controller
+        :param stepper_ID: serial number of the Tic controller
+        :param args: ticcmd options, e.g. "--resume", "--position", 100
+        :return: JobResult, containing the output of ticcmd in stdout
+        """
+        result = self.ticcmd_jobs.run(["ticcmd"] + list(args) + ["-d", stepper_ID])
+        if not result.ok:
+            print("ticcmd failed:", result)
+        return result
+
     def deEnergise(self):
         for stepper_ID in self.stepper_IDs:
-            os.system('ticcmd --deenergize -d ' + stepper_ID)
+            self.ticcmd(stepper_ID, "--deenergize")
 
     def resume(self):
         for stepper_ID in self.stepper_IDs:
-            os.system('ticcmd --resume --reset-command-timeout -d ' + stepper_ID)
+            self.ticcmd(stepper_ID, "--resume", "--reset-command-timeout")
 
     def setStepMode(self, stepper, step_mode):
         self.stepper_stepModes[stepper] = step_mode
-        os.system('ticcmd --step-mode ' + str(step_mode) + ' -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--step-mode", step_mode)
 
     def setCurrent(self, stepper, current):
         self.stepper_currents[stepper] = current
-        os.system('ticcmd --current ' + str(current) + ' -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--current", current)
 
     def setMaxAccel(self, stepper, max_accel):
         self.stepper_maxAccel[stepper] = max_accel
-        os.system('ticcmd --max-accel ' + str(max_accel) + ' -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--max-accel", max_accel)
 
     def setMaxSpeed(self, stepper, max_velocity):
         self.stepper_maxVelocity[stepper] = max_velocity
-        os.system('ticcmd --max-speed ' + str(max_velocity) + ' -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--max-speed", max_velocity)
 
     def home(self, stepper):
         if self.stepper_home_pos[stepper] != 0:
             print("Homing stepper", self.stepper_names[stepper])
-            os.system('ticcmd --resume --position ' + str(
-                self.stepper_home_pos[stepper]) + ' --reset-command-timeout -d ' + self.stepper_IDs[stepper])
+            self.ticcmd(self.stepper_IDs[stepper], "--resume", "--position", self.stepper_home_pos[stepper],
+                        "--reset-command-timeout")
 
             while not self.getLimitState(stepper):
-                os.system('ticcmd --resume --reset-command-timeout -d ' + self.stepper_IDs[stepper])
+                self.ticcmd(self.stepper_IDs[stepper], "--resume", "--reset-command-timeout")
                 # sleep(0.2)
 
-        os.system('ticcmd --halt-and-set-position 0 -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--halt-and-set-position", "0")
 
     def getStepperPosition(self, stepper):
-        info = os.popen('ticcmd --status -d ' + self.stepper_IDs[stepper]).read()
+        info = self.ticcmd(self.stepper_IDs[stepper], "--status").stdout
         # split returned results into its elements
         lines = info.split("\n")
         current_position = int(lines[21].split(" ")[-1])
         self.stepper_position[stepper] = current_position
 
     def getLimitState(self, stepper):
-        info = os.popen('ticcmd --status -d ' + self.stepper_IDs[stepper]).read()
+        info = self.ticcmd(self.stepper_IDs[stepper], "--status").stdout
         # split returned results into its elements
         lines = info.split("\n")
 
@@ -154,10 +178,10 @@ class ScannerController:
             print("Moving stepper", self.stepper_names[stepper], "to position",
                   pos)
 
-        os.system('ticcmd --resume --position ' + str(pos) + ' --reset-command-timeout -d ' + self.stepper_IDs[stepper])
+        self.ticcmd(self.stepper_IDs[stepper], "--resume", "--position", pos, "--reset-command-timeout")
         self.getStepperPosition(stepper)
         while self.stepper_position[stepper] != pos:
-            os.system('ticcmd --resume --reset-command-timeout -d ' + self.stepper_IDs[stepper])
+            self.ticcmd(self.stepper_IDs[stepper], "--resume", "--reset-command-timeout")
             self.getStepperPosition(stepper)
 
     def setScanRange(self, stepper, min, max, step):
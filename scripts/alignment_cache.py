@@ -0,0 +1,94 @@
+import re
+import numpy as np
+from pathlib import Path
+
+try:
+    from scripts.sidecar import JsonSidecar, get_shared
+except ModuleNotFoundError:
+    from sidecar import JsonSidecar, get_shared
+
+"""
+Alignment transform cache
+
+All stacks of a scan are captured at the same Z positions, so the magnification and shift between two neighbouring
+focus steps is nearly identical for every view. The cache stores the affine transform between each pair of
+neighbouring steps (keyed by their step names, e.g. "08000->08500") in the project folder
+(alignment_transforms.json). Later stacks use the stored transform as the starting point of a short refinement
+instead of estimating it from scratch, and the stored value is updated with the running mean of all refinements.
+
+{
+    "transforms": {
+        "08000->08500": {"warp": [[1.001, 0.0, -1.2], [0.0, 1.001, 0.8]], "count": 12},
+        ...
+    }
+}
+"""
+
+ALIGNMENT_CACHE_NAME = "alignment_transforms.json"
+
+
+def slice_key(image_path):
+    """
+    :return: the focus step name of a frame ("_step_08000_" -> "08000"), or None if it does not follow the
+             scAnt naming convention
+    """
+    match = re.search(r"_step_(\d+)_", Path(str(image_path)).name)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def pair_key(first_key, second_key):
+    if first_key is None or second_key is None:
+        return None
+    return first_key + "->" + second_key
+
+
+class AlignmentCache(JsonSidecar):
+    description = "alignment cache"
+
+    def __init__(self, cache_path):
+        self.transforms = {}
+        JsonSidecar.__init__(self, cache_path)
+
+    def from_json(self, content):
+        self.transforms = content.get("transforms", {})
+
+    def to_json(self):
+        return {"transforms": self.transforms}
+
+    def get(self, key):
+        """
+        :return: 2x3 float32 warp matrix stored for the pair of steps, or None
+        """
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.transforms.get(key)
+        if entry is None:
+            return None
+        return np.array(entry["warp"], dtype=np.float32)
+
+    def update(self, key, warp):
+        """
+        Adds a newly estimated transform to the running mean of the pair of steps
+        """
+        if key is None:
+            return
+        with self.lock:
+            entry = self.transforms.get(key)
+            if entry is None:
+                entry = {"warp": np.asarray(warp, dtype=np.float64).tolist(), "count": 1}
+            else:
+                count = entry["count"]
+                mean = (np.array(entry["warp"]) * count + np.asarray(warp, dtype=np.float64)) / (count + 1)
+                entry = {"warp": mean.tolist(), "count": count + 1}
+            self.transforms[key] = entry
+            self.changed = True
+
+
+def get_alignment_cache(project_folder):
+    """
+    Returns the shared AlignmentCache of the given project folder, loading it on first use
+    """
+    return get_shared(AlignmentCache, Path(project_folder).joinpath(ALIGNMENT_CACHE_NAME))
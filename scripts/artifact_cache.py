@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import cv2
+import numpy as np
+from pathlib import Path
+
+try:
+    from scripts.sidecar import JsonSidecar, get_shared
+except ModuleNotFoundError:
+    from sidecar import JsonSidecar, get_shared
+
+"""
+Content-addressed artifact cache
+
+Stores intermediate and final results of the post-processing (fused stacks, extracted contours) in the project's
+artifact_cache folder, named by a hash of the content of their inputs and of the parameters of the stage that
+produced them. A result is reused whenever the same inputs are processed with the same parameters again, no matter
+which file they are read from, so e.g. tuning the masking thresholds never re-runs edge detection. The cache is
+limited to max_size MB, the least recently used artifacts are removed first.
+
+    cache = get_artifact_cache(project_folder)
+    key = cache.key("stack", [cache.file_hash(path) for path in frames], {"backend": "pyramid"})
+    cached_path = cache.get(key, ".tif")
+"""
+
+ARTIFACT_CACHE_NAME = "artifact_cache"
+FILE_HASHES_NAME = "file_hashes.json"
+HASH_CHUNK_SIZE = 1 << 20
+# MB
+ARTIFACT_CACHE_MAX_SIZE = 10240
+
+
+def hash_array(array):
+    """
+    :return: hash of the pixel data of an image, independent of the file it was read from (and its metadata)
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str((array.shape, array.dtype.str)).encode())
+    digest.update(memoryview(array).cast("B"))
+    return digest.hexdigest()
+
+
+class ArtifactCache(JsonSidecar):
+    description = "file hashes"
+
+    def __init__(self, cache_folder, max_size=ARTIFACT_CACHE_MAX_SIZE):
+        self.cache_folder = Path(cache_folder)
+        self.max_size = max_size
+        # total size of the artifacts in bytes, counted on the first write
+        self.size = None
+        # file content hashes, reused while size and modification time of a file are unchanged (the sidecar file)
+        self.file_hashes = {}
+        JsonSidecar.__init__(self, self.cache_folder.joinpath(FILE_HASHES_NAME))
+
+    def from_json(self, content):
+        self.file_hashes = content
+
+    def to_json(self):
+        return self.file_hashes
+
+    def file_hash(self, path):
+        """
+        :return: hash of the content of a file
+        """
+        path = str(Path(path).resolve())
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.file_hashes.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        with self.lock:
+            self.file_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+            self.changed = True
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(stage, input_hashes, params):
+        """
+        :param stage: name of the processing stage, e.g. "stack"
+        :param input_hashes: list of content hashes of the inputs, in the order they are processed
+        :param params: dict of the parameters that change the result of the stage
+        :return: name of the artifact
+        """
+        content = json.dumps([stage, list(input_hashes), params], sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def path(self, key, suffix):
+        return self.cache_folder.joinpath(key[:2], key + suffix)
+
+    def get(self, key, suffix):
+        """
+        :return: path of the cached artifact, or None if it has not been produced yet
+        """
+        path = self.path(key, suffix)
+        if path.is_file():
+            try:
+                # marks the artifact as recently used
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+        return None
+
+    def put(self, key, source_path):
+        """
+        Stores a copy of a produced file (the original may be modified later on, e.g. when adding exif data)
+        """
+        path = self.path(key, Path(source_path).suffix)
+        os.makedirs(path.parent, exist_ok=True)
+        temp_path = path.with_name(path.name + "." + str(threading.get_ident()) + ".tmp")
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+        self.stored(path)
+
+    def get_image(self, key):
+        path = self.get(key, ".png")
+        if path is None:
+            return None
+        return cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+
+    def put_image(self, key, image):
+        """
+        Stores an 8 / 16 bit image (lossless)
+        """
+        path = self.path(key, ".png")
+        os.makedirs(path.parent, exist_ok=True)
+        temp_path = path.with_name(key + "." + str(threading.get_ident()) + ".tmp.png")
+        cv2.imwrite(str(temp_path), image)
+        os.replace(temp_path, path)
+        self.stored(path)
+
+    def artifacts(self):
+        """
+        :return: list of (last use, size, path) of all stored artifacts
+        """
+        artifacts = []
+        for path in self.cache_folder.glob("*/*"):
+            if path.name.endswith(".tmp") or path.name.endswith(".tmp.png"):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, path))
+        return artifacts
+
+    def stored(self, path):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.artifacts())
+            else:
+                self.size += path.stat().st_size
+            evict = self.size > self.max_size * 2 ** 20
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used artifacts until the cache is within max_size MB
+        """
+        artifacts = sorted(self.artifacts(), key=lambda artifact: artifact[0])
+        size = sum(artifact[1] for artifact in artifacts)
+        limit = self.max_size * 2 ** 20
+        for _, artifact_size, path in artifacts:
+            if size <= limit:
+                break
+            try:
+                path.unlink()
+                size -= artifact_size
+            except OSError:
+                pass
+        with self.lock:
+            self.size = size
+
+
+def get_artifact_cache(project_folder, max_size=None):
+    """
+    Returns the shared ArtifactCache of the given project folder
+    :param max_size: size limit in MB (ARTIFACT_CACHE_MAX_SIZE by default, applies to the shared instance)
+    """
+    cache = get_shared(ArtifactCache, Path(project_folder).joinpath(ARTIFACT_CACHE_NAME))
+    if max_size is not None:
+        cache.max_size = max_size
+    return cache
@@ -0,0 +1,219 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+from pathlib import Path
+
+from processStack import score_frames, classify_focus, process_stack, get_num_workers
+from scripts.frame_index import FrameIndex
+from scripts.focus_stacking import load_image, align_stack, fuse_stack
+from scripts.stacking_backends import get_backend, backend_names, BENCHMARK_REPORT_NAME
+
+"""
+Stacking benchmark
+
+Generates synthetic focus stacks with a known all-in-focus image and depth, runs them through the same functions
+stack_images uses and writes the timings (and the accuracy of the results) of every stage and stacking method to a
+JSON report, which the "auto" stacking method reads to pick the fastest backend. Run from the repository root:
+
+    python -m scripts.benchmark_stacking --width 2000 --height 1500 --slices 20 --noise 2 -o benchmark_stacking.json
+
+{
+    "created": "2021-03-01T12:00:00", "platform": {...}, "settings": {...},
+    "stages": {"focus_check": 1.2, "grouping": 0.05},
+    "methods": {
+        "pyramid": {"available": true, "seconds": 10.4, "megapixel_slices_per_second": 5.8, "rmse": 1.9,
+                    "depth_accuracy": 0.84, "alignment": 6.1, "fusion": 4.0},
+        ...
+    }
+}
+"""
+
+def make_synthetic_stack(width=1000, height=750, num_slices=10, noise=1.0, blur_per_step=1.5, magnification=0.002,
+                         seed=0):
+    """
+    Creates a synthetic focus stack of a textured surface with a tilted, bumpy depth profile
+    :param noise: standard deviation of the sensor noise added to every slice (8 bit grey levels)
+    :param blur_per_step: Gaussian blur (px) per focus step of distance from the in-focus plane
+    :param magnification: change of magnification between neighbouring slices, to be corrected by the alignment
+    :return: all-in-focus image, list of slices (uint8, furthest first) and depth map (in-focus slice per pixel)
+    """
+    rng = np.random.default_rng(seed)
+    texture = cv2.GaussianBlur(rng.random((height, width)).astype(np.float32), (0, 0), 1.5)
+    texture = cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX)
+    sharp = np.dstack([texture, texture * 0.8 + 20, texture * 0.6 + 40]).astype(np.float32)
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    bump = np.exp(-(((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 4)) ** 2))
+    depth = (x / width * 0.6 + bump * 0.4) * (num_slices - 1)
+
+    # blurred versions of the surface, one per whole focus step of defocus
+    blurred = [sharp] + [cv2.GaussianBlur(sharp, (0, 0), step * blur_per_step) for step in range(1, num_slices)]
+
+    slices = []
+    for k in range(num_slices):
+        defocus = np.clip(np.rint(np.abs(depth - k)), 0, num_slices - 1).astype(np.int32)
+        image = np.zeros_like(sharp)
+        for step in np.unique(defocus):
+            selected = defocus == step
+            image[selected] = blurred[step][selected]
+
+        # the last slice is stacked first, so the result is registered to it
+        scale = 1.0 - magnification * (num_slices - 1 - k)
+        warp = cv2.getRotationMatrix2D((width / 2, height / 2), 0, scale)
+        image = cv2.warpAffine(image, warp, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        image += rng.normal(0, noise, image.shape).astype(np.float32)
+        slices.append(np.clip(np.rint(image), 0, 255).astype(np.uint8))
+
+    return sharp.astype(np.uint8), slices, depth
+
+
+def write_project(project_folder, slices, num_stacks=1):
+    """
+    Writes the slices as scAnt frames (_x_#####_y_#####_step_#####_.tif) of num_stacks views into project/RAW
+    :return: list of frame paths
+    """
+    raw_folder = Path(project_folder).joinpath("RAW")
+    os.makedirs(raw_folder, exist_ok=True)
+    frame_paths = []
+    for view in range(num_stacks):
+        for k, image in enumerate(slices):
+            name = "_x_00000_y_" + str(view * 80).zfill(5) + "_step_" + str(8000 + 500 * k).zfill(5) + "_.tif"
+            cv2.imwrite(str(raw_folder.joinpath(name)), image)
+            frame_paths.append(raw_folder.joinpath(name))
+    return frame_paths
+
+
+def compare(result_path, sharp, depth, slice_order, margin=0.1):
+    """
+    :return: RMSE of the fused image and share of pixels assigned to their in-focus slice (if a depth map was
+             written), ignoring a border of margin * size that is affected by the alignment
+    """
+    fused = cv2.imread(str(result_path), cv2.IMREAD_COLOR)
+    if fused is None or fused.shape != sharp.shape:
+        return None, None
+    border_y, border_x = int(sharp.shape[0] * margin), int(sharp.shape[1] * margin)
+    crop = (slice(border_y, sharp.shape[0] - border_y), slice(border_x, sharp.shape[1] - border_x))
+    rmse = float(np.sqrt(np.mean((fused[crop].astype(np.float64) - sharp[crop]) ** 2)))
+
+    depth_accuracy = None
+    depth_path = Path(result_path).with_name(Path(result_path).stem + "_depth.png")
+    if depth_path.is_file():
+        index = cv2.imread(str(depth_path), cv2.IMREAD_UNCHANGED)
+        # the depth map counts slices in stacking order
+        in_focus = slice_order[np.clip(index, 0, len(slice_order) - 1)]
+        depth_accuracy = float(np.mean(in_focus[crop] == np.rint(depth[crop])))
+    return rmse, depth_accuracy
+
+
+def run_benchmark(width=1000, height=750, num_slices=10, noise=1.0, num_stacks=1, methods=None, repeats=1,
+                  grouping_frames=20000, seed=0):
+    """
+    :return: report dict (see module docstring)
+    """
+    methods = methods or backend_names()
+    path_to_external = Path(__file__).resolve().parent.parent.joinpath("external")
+    report = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+              "platform": {"system": platform.system(), "machine": platform.machine(),
+                           "python": platform.python_version(), "opencv": cv2.__version__,
+                           "cores": get_num_workers()},
+              "settings": {"width": width, "height": height, "slices": num_slices, "noise": noise,
+                           "stacks": num_stacks, "repeats": repeats, "grouping_frames": grouping_frames,
+                           "seed": seed},
+              "stages": {},
+              "methods": {}}
+
+    sharp, slices, depth = make_synthetic_stack(width, height, num_slices, noise=noise, seed=seed)
+    project_folder = Path(tempfile.mkdtemp(prefix="scAnt_benchmark_"))
+    try:
+        frame_paths = write_project(project_folder, slices, num_stacks)
+
+        start = time.time()
+        classify_focus(score_frames(frame_paths), mode="relative", fraction=0.0)
+        report["stages"]["focus_check"] = time.time() - start
+
+        names = ["_x_" + str(i // 4000).zfill(5) + "_y_" + str(i // 20 % 200 * 80).zfill(5) + "_step_" +
+                 str(8000 + 500 * (i % 20)).zfill(5) + "_.tif" for i in range(grouping_frames)]
+        start = time.time()
+        FrameIndex(names).stacks(min_frames=2)
+        report["stages"]["grouping"] = time.time() - start
+
+        stacks = FrameIndex(frame_paths).stacks(min_frames=2)
+        output_folder = project_folder.joinpath("stacked")
+        os.makedirs(output_folder, exist_ok=True)
+        megapixel_slices = width * height * num_slices * len(stacks) / 1e6
+
+        for method in methods:
+            backend = get_backend(method)
+            if not backend.available(path_to_external):
+                report["methods"][method] = {"available": False}
+                continue
+
+            params = {"backend": method, "sharpen": False, "artifact_cache": False,
+                      "depth_map": backend.depth_map}
+            durations = []
+            for _ in range(repeats):
+                # transforms cached by earlier runs would make later runs faster than a fresh scan
+                for cache_file in project_folder.glob("alignment_transforms.json"):
+                    cache_file.unlink()
+                start = time.time()
+                for _, stack_paths in stacks:
+                    process_stack("".join(" " + str(path) for path in stack_paths), output_folder,
+                                  path_to_external, params)
+                durations.append(time.time() - start)
+
+            # stacks are ordered furthest first, i.e. the first slice of the stack is the last one captured
+            slice_order = np.arange(num_slices)[::-1]
+            rmse, depth_accuracy = compare(output_folder.joinpath(stacks[0][0] + ".tif"), sharp, depth,
+                                           slice_order)
+            report["methods"][method] = {"available": True,
+                                         "seconds": min(durations),
+                                         "megapixel_slices_per_second": megapixel_slices / min(durations),
+                                         "rmse": rmse,
+                                         "depth_accuracy": depth_accuracy}
+
+        # alignment and fusion of the in-process engine on their own
+        images = [load_image(path) for path in stacks[0][1]]
+        start = time.time()
+        aligned, _ = align_stack(images)
+        alignment = time.time() - start
+        start = time.time()
+        fuse_stack(aligned)
+        fusion = time.time() - start
+        if "pyramid" in report["methods"]:
+            report["methods"]["pyramid"]["alignment"] = alignment
+            report["methods"]["pyramid"]["fusion"] = fusion
+    finally:
+        shutil.rmtree(project_folder, ignore_errors=True)
+
+    return report
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the stacking methods on synthetic focus stacks")
+    ap.add_argument("--width", type=int, default=1000, help="width of the synthetic frames (1000 by default)")
+    ap.add_argument("--height", type=int, default=750, help="height of the synthetic frames (750 by default)")
+    ap.add_argument("--slices", type=int, default=10, help="number of slices per stack (10 by default)")
+    ap.add_argument("--noise", type=float, default=1.0, help="standard deviation of the added noise (1.0 by default)")
+    ap.add_argument("--stacks", type=int, default=1, help="number of stacks (1 by default)")
+    ap.add_argument("--methods", nargs="+", choices=backend_names(), help="stacking backends to run (all by default)")
+    ap.add_argument("--repeats", type=int, default=1, help="runs per method, the fastest one is reported")
+    ap.add_argument("--seed", type=int, default=0, help="seed of the synthetic stack")
+    ap.add_argument("-o", "--output", default=BENCHMARK_REPORT_NAME, help="path of the JSON report")
+    args = vars(ap.parse_args())
+
+    report = run_benchmark(width=args["width"], height=args["height"], num_slices=args["slices"],
+                           noise=args["noise"], num_stacks=args["stacks"], methods=args["methods"],
+                           repeats=args["repeats"], seed=args["seed"])
+
+    with open(args["output"], "w") as f:
+        json.dump(report, f, indent=4)
+
+    print(json.dumps(report, indent=4))
+    print("Report written to", args["output"])
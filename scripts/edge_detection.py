@@ -0,0 +1,38 @@
+import os
+import threading
+import cv2
+from pathlib import Path
+
+"""
+Edge detector cache
+
+Loading the structured edge detection model (scripts/model.yml) takes a noticeable amount of time, so every thread
+(GUI thread pool, masking threads) and every worker process loads it once and reuses it for all following masks.
+Detectors are not shared between threads, as detectEdges is not guaranteed to be thread safe, and a forked worker
+process loads its own copy.
+
+    edge_detector = get_edge_detector()
+    edges = edge_detector.detectEdges(image_float)
+"""
+
+EDGE_MODEL_PATH = Path(__file__).resolve().parent.joinpath("model.yml")
+
+_thread_detectors = threading.local()
+
+
+def get_edge_detector(model_path=EDGE_MODEL_PATH):
+    """
+    Returns the structured edge detector of the calling thread, loading the model on first use
+    :param model_path: path of the pre-trained model
+    """
+    model_path = str(Path(model_path).resolve())
+    if getattr(_thread_detectors, "pid", None) != os.getpid():
+        _thread_detectors.pid = os.getpid()
+        _thread_detectors.detectors = {}
+
+    edge_detector = _thread_detectors.detectors.get(model_path)
+    if edge_detector is None:
+        edge_detector = cv2.ximgproc.createStructuredEdgeDetection(model_path)
+        _thread_detectors.detectors[model_path] = edge_detector
+        print("loaded edge detector...")
+    return edge_detector
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+
+try:
+    from scripts.sidecar import JsonSidecar, get_shared
+except ModuleNotFoundError:
+    from sidecar import JsonSidecar, get_shared
+
+"""
+Persistent focus score index
+
+Stores the focus measure of every frame of a project in a sidecar file (focus_scores.json) next to the RAW
+folder. Entries are keyed by the frame path (relative to the project folder) and are only reused while the size
+and modification time of the frame are unchanged, so re-running the focus check or tuning the threshold of a
+finished scan only scores new or changed frames.
+
+{
+    "settings": {"scale_percent": 15},
+    "frames": {
+        "RAW/_x_00000_y_00000_step_08000_.tif": {"size": 15040938, "mtime": 1601234567890123456, "score": 12.3},
+        ...
+    }
+}
+"""
+
+FOCUS_INDEX_NAME = "focus_scores.json"
+
+
+class FocusIndex(JsonSidecar):
+    description = "focus index"
+
+    def __init__(self, index_path, settings=None):
+        """
+        :param index_path: location of the sidecar file
+        :param settings: dict of scoring parameters, stored entries are discarded if these differ
+        """
+        self.settings = settings if settings is not None else {}
+        self.frames = {}
+        JsonSidecar.__init__(self, index_path)
+
+    def from_json(self, content):
+        if content.get("settings", {}) != self.settings:
+            print("Focus scoring settings changed, discarding stored focus scores")
+            self.changed = True
+            return
+
+        self.frames = content.get("frames", {})
+
+    def to_json(self):
+        return {"settings": self.settings, "frames": self.frames}
+
+    @staticmethod
+    def _signature(image_path):
+        stat = os.stat(image_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, image_path, field="score"):
+        """
+        :return: the stored value of the frame, or None if the frame is unknown or has changed since
+        """
+        key = self._key(image_path)
+        with self.lock:
+            entry = self.frames.get(key)
+        if entry is None or field not in entry:
+            return None
+
+        try:
+            size, mtime = self._signature(image_path)
+        except OSError:
+            return None
+        if entry["size"] != size or entry["mtime"] != mtime:
+            return None
+
+        return entry[field]
+
+    def set(self, image_path, value, field="score"):
+        key = self._key(image_path)
+        size, mtime = self._signature(image_path)
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+                entry = {"size": size, "mtime": mtime}
+                self.frames[key] = entry
+            entry[field] = value
+            self.changed = True
+
+
+def get_focus_index(index_path, settings=None):
+    """
+    Returns the shared FocusIndex of the given sidecar file, loading it on first use
+    """
+    # one shared index per file and process, so concurrent stacking threads of the GUI do not overwrite each other
+    settings = settings if settings is not None else {}
+    return get_shared(FocusIndex, index_path, create=lambda path: FocusIndex(path, settings=settings),
+                      is_current=lambda index: index.settings == settings)
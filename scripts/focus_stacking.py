@@ -0,0 +1,807 @@
+import cv2
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+try:
+    from scripts.alignment_cache import slice_key, pair_key
+    from scripts.frame_index import parse_frame_name
+except ModuleNotFoundError:
+    from alignment_cache import slice_key, pair_key
+    from frame_index import parse_frame_name
+
+"""
+In-process focus stacking
+
+Aligns and fuses the slices of a stack with OpenCV and numpy, as an alternative to running align_image_stack and
+enfuse (or focus-stack) as external programs. All slices are kept in memory, so no intermediate files are written.
+
+Alignment:  affine ECC (enhanced correlation coefficient) between neighbouring slices, chained to the first slice
+            of the stack. Transforms are estimated coarse-to-fine on a Gaussian pyramid (ALIGN_LEVELS deep) whose
+            finest level is downscaled to ALIGN_MAX_SIZE (like align_image_stack) unless full resolution alignment
+            is requested, and each slice is then warped once at full resolution.
+            With an AlignmentCache, transforms between focus steps known from earlier stacks of the scan are only
+            refined briefly at REFINE_MAX_SIZE.
+Fusion:     equivalent to the enfuse settings used for hugin stacking
+            (--exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --contrast-edge-scale=1):
+            every pixel is taken from the slice with the highest local contrast (hard mask), and the masks are
+            blended across a Laplacian pyramid to hide the seams.
+Streaming:  StreamingStacker merges slices one at a time into a running result (hard mask only), so memory stays
+            constant in stack depth and slices can be fused while the stack is still being captured.
+Tiled:      stack_focus_tiled aligns the slices one at a time into a memory map on disk and fuses the stack in
+            tiles with a halo of TILE_HALO_FACTOR * 2 ** TILE_LEVELS px, sized to fit a peak memory budget.
+            With num_workers > 1 the tiles are fused in parallel by a process pool shared by all stacks, so the
+            last large stacks of a scan still use every core.
+Depth map:  with depth_map=True every engine also writes the index of the slice each pixel was taken from
+            (0 = first slice of the stack) as a 16 bit PNG next to the result (<name>_depth.png), taken from the
+            same selection that drives the fusion.
+Preview:    stack_focus(..., scale=0.25) decodes, aligns and fuses downscaled 8 bit slices, for a quick check of
+            lighting, framing and focus range of a scan.
+"""
+
+# longest side of the images used to estimate the alignment (None to align at full resolution)
+ALIGN_MAX_SIZE = 2048
+# number of pyramid levels used for coarse-to-fine alignment and the ECC convergence threshold of each level
+ALIGN_LEVELS = 3
+ALIGN_EPS = 1e-5
+# coarsest pyramid level used for alignment, in px along the shorter side
+ALIGN_MIN_SIZE = 64
+# longest side and number of iterations used to refine a transform known from an earlier stack
+REFINE_MAX_SIZE = 1024
+REFINE_ITERATIONS = 20
+# standard deviation of the Gaussian applied before computing the local contrast (enfuse --contrast-edge-scale)
+CONTRAST_EDGE_SCALE = 1.0
+# smoothing of the contrast map used for streaming selection, replaces the seam blending of the pyramid
+STREAMING_CONTRAST_WINDOW = 2.0
+# peak memory in MB used by stack_focus_tiled to fuse a tile (all slices of the tile and the pyramid working memory)
+TILED_MEMORY_BUDGET = 2048
+# pyramid levels used for fusing tiles, tiles overlap by TILE_HALO_FACTOR * 2 ** TILE_LEVELS px so the blending
+# of neighbouring tiles matches along the seams
+TILE_LEVELS = 5
+TILE_HALO_FACTOR = 4
+# every tile re-fuses its halo, parallel tiling uses no more workers than keep the tiles at least this many halos
+# wide (at most (1 + 2 / 8) ** 2 = 1.56x the fusion work of a single pass)
+TILE_MIN_SIZE_HALOS = 8
+# estimated working memory of fuse_stack per pixel and channel (float32 pyramids of one slice and the result)
+FUSE_BYTES_PER_PIXEL = 20
+# decoders that support it (JPEG) skip the full resolution reconstruction when loading downscaled slices
+REDUCED_COLOR_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                       (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def load_image(image_path, scale=1.0):
+    """
+    :param scale: factor applied to both sides of the image, downscaled images are decoded as 8 bit
+    """
+    if scale >= 1.0:
+        image = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
+    else:
+        image = None
+        reduction = 1
+        for factor, flag in REDUCED_COLOR_FLAGS:
+            if factor * scale <= 1.0:
+                image = cv2.imread(str(image_path), flag)
+                reduction = factor
+                break
+        if image is None:
+            reduction = 1
+            image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+        if image is not None:
+            remaining = scale * reduction
+            size = (max(int(round(image.shape[1] * remaining)), 1), max(int(round(image.shape[0] * remaining)), 1))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    if image is None:
+        raise IOError("Could not read " + str(image_path))
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = image[:, :, :3]
+    return image
+
+
+def to_gray(image):
+    """
+    :return: single channel float32 image in the range [0, 1]
+    """
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    return gray.astype(np.float32) / float(np.iinfo(image.dtype).max)
+
+
+def downscale(image, max_size):
+    """
+    :return: image with its longest side reduced to max_size, and the applied scale
+    """
+    if max_size is None:
+        return image, 1.0
+    scale = min(1.0, float(max_size) / max(image.shape[:2]))
+    if scale == 1.0:
+        return image, scale
+    size = (max(int(round(image.shape[1] * scale)), 1), max(int(round(image.shape[0] * scale)), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def estimate_transform(template_gray, moving_gray, max_size=ALIGN_MAX_SIZE, iterations=100, eps=ALIGN_EPS,
+                       warp_init=None, levels=1):
+    """
+    Estimates the affine transform mapping coordinates of template_gray onto moving_gray. The transform is first
+    estimated on the coarsest of levels pyramid levels and refined on each finer level, so most iterations run on
+    small images and large shifts still converge.
+    :param max_size: longest side of the finest level used (None for full resolution)
+    :param eps: convergence threshold of the ECC optimisation on each level
+    :param warp_init: 2x3 full resolution warp matrix to start from (identity by default)
+    :param levels: number of pyramid levels
+    :return: 2x3 float32 warp matrix at full resolution, usable with cv2.WARP_INVERSE_MAP
+    """
+    template_small, scale = downscale(template_gray, max_size)
+    moving_small, _ = downscale(moving_gray, max_size)
+
+    # limit the depth, so the coarsest level still contains enough structure
+    max_levels = max(int(np.log2(min(template_small.shape[:2]) / float(ALIGN_MIN_SIZE))) + 1, 1)
+    levels = max(min(levels, max_levels), 1)
+    template_pyramid = gaussian_pyramid(template_small, levels)
+    moving_pyramid = gaussian_pyramid(moving_small, levels)
+
+    if warp_init is None:
+        warp_init = np.eye(2, 3, dtype=np.float32)
+    warp = np.array(warp_init, dtype=np.float32)
+    # the linear part is scale invariant, only the translation depends on the level
+    warp[:, 2] *= scale / 2 ** (levels - 1)
+
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, eps)
+    converged = False
+    for level in reversed(range(levels)):
+        try:
+            _, warp = cv2.findTransformECC(template_pyramid[level], moving_pyramid[level], warp,
+                                           cv2.MOTION_AFFINE, criteria, None, 5)
+            converged = True
+        except cv2.error as e:
+            # keep the estimate of the coarser level
+            print("Alignment did not converge on pyramid level", level, ":", e)
+        if level > 0:
+            warp[:, 2] *= 2
+
+    if not converged:
+        print("Alignment did not converge, using initial transform")
+        return np.array(warp_init, dtype=np.float32)
+
+    warp[:, 2] /= scale
+    return warp
+
+
+def compose(first, second):
+    """
+    :return: 2x3 warp matrix applying first, then second (both mapping reference -> slice coordinates)
+    """
+    first_h = np.vstack([first, [0, 0, 1]])
+    second_h = np.vstack([second, [0, 0, 1]])
+    return (second_h @ first_h)[:2].astype(np.float32)
+
+
+def warp_image(image, warp):
+    return cv2.warpAffine(image, warp, (image.shape[1], image.shape[0]),
+                          flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+
+
+def estimate_step(template_gray, moving_gray, key=None, alignment_cache=None, max_size=ALIGN_MAX_SIZE,
+                  align_levels=ALIGN_LEVELS, align_eps=ALIGN_EPS):
+    """
+    Estimates the transform between two neighbouring slices. If the alignment cache already holds a transform for
+    this pair of focus steps, it is only refined at reduced size and with few iterations.
+    """
+    prior = alignment_cache.get(key) if alignment_cache is not None else None
+    if prior is None:
+        step = estimate_transform(template_gray, moving_gray, max_size=max_size, eps=align_eps, levels=align_levels)
+    else:
+        refine_size = REFINE_MAX_SIZE if max_size is None else min(max_size, REFINE_MAX_SIZE)
+        step = estimate_transform(template_gray, moving_gray, max_size=refine_size, eps=align_eps,
+                                  iterations=REFINE_ITERATIONS, warp_init=prior)
+    if alignment_cache is not None:
+        alignment_cache.update(key, step)
+    return step
+
+
+def align_stack(images, max_size=ALIGN_MAX_SIZE, keys=None, alignment_cache=None, align_levels=ALIGN_LEVELS,
+                align_eps=ALIGN_EPS):
+    """
+    Aligns all slices to the first slice of the stack. Each slice is registered against its predecessor, as
+    neighbouring slices share most of their in-focus structure, and the transforms are chained.
+    :param images: list of images, ordered by focus position
+    :param max_size: longest side of the finest alignment level (None for full resolution)
+    :param align_levels: number of pyramid levels used for coarse-to-fine alignment
+    :param align_eps: ECC convergence threshold of each level
+    :param keys: focus step names of the slices (see alignment_cache.slice_key), used to look up cached transforms
+    :param alignment_cache: AlignmentCache of the project (optional)
+    :return: list of aligned images and list of the 2x3 warp matrices used
+    """
+    if keys is None:
+        keys = [None] * len(images)
+    transforms = [np.eye(2, 3, dtype=np.float32)]
+    aligned = [images[0]]
+    previous_gray = to_gray(images[0])
+    for i in range(1, len(images)):
+        gray = to_gray(images[i])
+        step = estimate_step(previous_gray, gray, key=pair_key(keys[i - 1], keys[i]),
+                             alignment_cache=alignment_cache, max_size=max_size, align_levels=align_levels,
+                             align_eps=align_eps)
+        transforms.append(compose(transforms[-1], step))
+        aligned.append(warp_image(images[i], transforms[-1]))
+        previous_gray = gray
+
+    if alignment_cache is not None:
+        alignment_cache.save()
+
+    return aligned, transforms
+
+
+def contrast_map(image):
+    """
+    Local contrast as used by enfuse with --contrast-edge-scale: magnitude of the Laplacian of Gaussian
+    """
+    blurred = cv2.GaussianBlur(to_gray(image), (0, 0), CONTRAST_EDGE_SCALE)
+    return np.abs(cv2.Laplacian(blurred, cv2.CV_32F))
+
+
+def pyramid_levels(shape, levels=None):
+    # stop once the smallest level is around 16 px, similar to enfuse's automatic level count
+    max_levels = max(int(np.log2(min(shape[:2]))) - 4, 1)
+    if levels is None:
+        return min(max_levels, 10)
+    return max(min(levels, max_levels), 1)
+
+
+def gaussian_pyramid(image, levels):
+    pyramid = [image]
+    for _ in range(levels - 1):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def laplacian_pyramid(image, levels):
+    gaussian = gaussian_pyramid(image, levels)
+    pyramid = []
+    for level in range(levels - 1):
+        size = (gaussian[level].shape[1], gaussian[level].shape[0])
+        pyramid.append(gaussian[level] - cv2.pyrUp(gaussian[level + 1], dstsize=size))
+    pyramid.append(gaussian[-1])
+    return pyramid
+
+
+def collapse_pyramid(pyramid):
+    image = pyramid[-1]
+    for level in reversed(pyramid[:-1]):
+        image = cv2.pyrUp(image, dstsize=(level.shape[1], level.shape[0])) + level
+    return image
+
+
+def select_sharpest(images):
+    """
+    Hard mask selection: index of the slice with the highest local contrast for every pixel
+    :return: uint16 index map
+    """
+    best = None
+    index = np.zeros(images[0].shape[:2], dtype=np.uint16)
+    for i, image in enumerate(images):
+        contrast = contrast_map(image)
+        if best is None:
+            best = contrast
+            continue
+        sharper = contrast > best
+        best[sharper] = contrast[sharper]
+        index[sharper] = i
+
+    return index
+
+
+def depth_map_path(output_path):
+    output_path = Path(output_path)
+    return str(output_path.with_name(output_path.stem + "_depth.png"))
+
+
+def depth_steps_path(output_path):
+    output_path = Path(output_path)
+    return str(output_path.with_name(output_path.stem + "_depth.json"))
+
+
+def save_depth_steps(output_path, image_paths, encoding="slice index"):
+    """
+    Writes the frame and focus step (Z position) of every slice a depth map refers to (<name>_depth.json), as the
+    index counts only the slices that were stacked (e.g. those that passed the focus check)
+    :param image_paths: paths of the stacked slices, in the order of the index (None for slices without a path)
+    :param encoding: how the values of the depth map relate to the listed slices
+    """
+    slices = []
+    for image_path in image_paths:
+        position = parse_frame_name(image_path)[1] if image_path is not None else None
+        slices.append({"frame": Path(str(image_path)).name if image_path is not None else None,
+                       "step": position[2] if position is not None else None})
+    path = depth_steps_path(output_path)
+    with open(path, "w") as f:
+        json.dump({"encoding": encoding, "slices": slices}, f, indent=1)
+    return path
+
+
+def save_depth_map(index, output_path, image_paths=None):
+    """
+    Writes the slice index map of a fused image as 16 bit PNG (<name>_depth.png)
+    :param image_paths: paths of the stacked slices in the order of the index, listed in <name>_depth.json
+    """
+    path = depth_map_path(output_path)
+    cv2.imwrite(path, np.asarray(index, dtype=np.uint16))
+    if image_paths is not None:
+        save_depth_steps(output_path, image_paths)
+    print("Depth map saved as", path)
+    return path
+
+
+def remove_depth_map(output_path):
+    """
+    Removes the depth map of a previous run, so a re-stack without depth map does not leave an outdated one behind
+    """
+    for path in (depth_map_path(output_path), depth_steps_path(output_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def fuse_stack(images, levels=None, return_index=False):
+    """
+    Fuses aligned slices into a single all-in-focus image, blending the hard masks across a Laplacian pyramid
+    :param images: list of aligned images (same shape and dtype)
+    :param levels: number of pyramid levels, chosen automatically by default
+    :param return_index: additionally return the slice index map used for the fusion
+    :return: fused image of the same dtype as the input (and the uint16 index map)
+    """
+    index = select_sharpest(images)
+    levels = pyramid_levels(index.shape, levels)
+
+    fused = None
+    for i, image in enumerate(images):
+        mask = (index == i).astype(np.float32)
+        if not mask.any():
+            continue
+        mask_pyramid = gaussian_pyramid(mask, levels)
+        image_pyramid = laplacian_pyramid(image.astype(np.float32), levels)
+        if fused is None:
+            fused = [np.zeros_like(level) for level in image_pyramid]
+        for level in range(levels):
+            weight = mask_pyramid[level]
+            if image_pyramid[level].ndim == 3:
+                weight = weight[:, :, np.newaxis]
+            fused[level] += image_pyramid[level] * weight
+
+    result = collapse_pyramid(fused)
+    max_value = np.iinfo(images[0].dtype).max
+    result = np.clip(np.rint(result), 0, max_value).astype(images[0].dtype)
+    if return_index:
+        return result, index
+    return result
+
+
+def stack_focus(image_paths, output_path, align=True, levels=None, alignment_cache=None, align_settings=None,
+                scale=1.0, depth_map=False):
+    """
+    Aligns and fuses the given slices and writes the result to output_path
+    :param image_paths: paths of all slices of the stack, ordered by focus position
+    :param alignment_cache: AlignmentCache of the project, to reuse transforms between focus steps (optional)
+    :param align_settings: dict of max_size, align_levels and align_eps passed to align_stack (optional)
+    :param scale: stack downscaled (8 bit) slices, e.g. 0.25 for a quick preview. Cached transforms are only
+                  used at full scale.
+    :param depth_map: also write the slice index map (see save_depth_map)
+    :return: output_path
+    """
+    if scale < 1.0:
+        alignment_cache = None
+    images = [load_image(image_path, scale=scale) for image_path in image_paths]
+    if align and len(images) > 1:
+        print("Aligning", len(images), "images of", Path(output_path).name)
+        images, _ = align_stack(images, keys=[slice_key(image_path) for image_path in image_paths],
+                                alignment_cache=alignment_cache, **(align_settings or {}))
+
+    print("Fusing", len(images), "images of", Path(output_path).name)
+    fused, index = fuse_stack(images, levels=levels, return_index=True)
+    cv2.imwrite(str(output_path), fused)
+    if depth_map:
+        save_depth_map(index, output_path, image_paths)
+
+    return output_path
+
+
+class StreamingStacker:
+    """
+    Incremental focus stacker. Keeps the running fused image, the best local contrast seen so far for every
+    pixel and the index of the slice it came from. Each new slice is aligned to its predecessor and merged
+    into the running result, so only one slice is held in memory at any time.
+    """
+
+    def __init__(self, align=True, max_size=ALIGN_MAX_SIZE, alignment_cache=None, align_levels=ALIGN_LEVELS,
+                 align_eps=ALIGN_EPS):
+        self.align = align
+        self.max_size = max_size
+        self.align_levels = align_levels
+        self.align_eps = align_eps
+        self.alignment_cache = alignment_cache
+        self.previous_key = None
+        self.fused = None
+        self.best = None
+        self.index = None
+        self.transform = np.eye(2, 3, dtype=np.float32)
+        self.previous_gray = None
+        self.num_slices = 0
+
+    def add(self, image, key=None):
+        """
+        :param image: next slice of the stack
+        :param key: focus step name of the slice (see alignment_cache.slice_key), used to look up cached transforms
+        """
+        gray = to_gray(image)
+        if self.fused is not None and self.align:
+            step = estimate_step(self.previous_gray, gray, key=pair_key(self.previous_key, key),
+                                 alignment_cache=self.alignment_cache, max_size=self.max_size,
+                                 align_levels=self.align_levels, align_eps=self.align_eps)
+            self.transform = compose(self.transform, step)
+            image = warp_image(image, self.transform)
+        self.previous_gray = gray
+        self.previous_key = key
+
+        # without pyramid blending, a smoothed contrast map avoids noisy switching between slices
+        contrast = cv2.GaussianBlur(contrast_map(image), (0, 0), STREAMING_CONTRAST_WINDOW)
+
+        if self.fused is None:
+            self.fused = image.copy()
+            self.best = contrast
+            self.index = np.zeros(image.shape[:2], dtype=np.uint16)
+        else:
+            sharper = contrast > self.best
+            self.fused[sharper] = image[sharper]
+            self.best[sharper] = contrast[sharper]
+            self.index[sharper] = self.num_slices
+
+        self.num_slices += 1
+
+    def add_path(self, image_path):
+        self.add(load_image(image_path), key=slice_key(image_path))
+
+    def result(self):
+        if self.alignment_cache is not None:
+            self.alignment_cache.save()
+        return self.fused
+
+    def depth(self):
+        """
+        :return: uint16 map of the index of the slice (in the order they were added) each pixel was taken from
+        """
+        return self.index
+
+
+# seconds a handed over slice file has to keep its size before it is read (the camera software may still be writing)
+FILE_SETTLE_TIME = 0.5
+
+
+def file_is_complete(image_path):
+    """
+    :return: False for JPEGs that do not end with their EOI marker (yet). A truncated JPEG decodes without error, so
+             the decoder alone cannot tell whether the file is still being written
+    """
+    if Path(str(image_path)).suffix.lower() not in (".jpg", ".jpeg"):
+        return True
+    with open(str(image_path), "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 64, 0))
+        # some cameras pad the file after the marker
+        return f.read().rstrip(b"\x00").endswith(b"\xff\xd9")
+
+
+class StreamingStackThread(threading.Thread):
+    """
+    Runs a StreamingStacker in the background. Slices (paths or images) are handed over with put() as soon as
+    they are captured; put(None) marks a slice that failed and will not arrive. Once num_slices slices have been
+    handed over, finish() writes the fused image to output_path.
+    """
+
+    _STOP = object()
+
+    def __init__(self, output_path, num_slices, align=True, file_timeout=30.0, alignment_cache=None,
+                 align_settings=None, depth_map=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.output_path = output_path
+        self.depth_map = depth_map
+        self.num_slices = num_slices
+        self.file_timeout = file_timeout
+        self.stacker = StreamingStacker(align=align, alignment_cache=alignment_cache, **(align_settings or {}))
+        # paths of the slices that were fused, in the order of the depth map index
+        self.fused_paths = []
+        self.q = queue.Queue()
+
+    def put(self, image_slice):
+        self.q.put(image_slice)
+
+    def cancel(self):
+        self.q.put(self._STOP)
+
+    def _load(self, image_path):
+        # slices may be handed over while the camera is still writing them to the drive, so they are only read once
+        # their size has stopped changing (and JPEGs are complete)
+        deadline = time.time() + self.file_timeout
+        last_size = None
+        while True:
+            try:
+                size = os.path.getsize(str(image_path))
+            except OSError:
+                size = None
+            if size and size == last_size and file_is_complete(image_path):
+                image = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
+                if image is not None:
+                    return image
+            if time.time() > deadline:
+                raise IOError("Could not read " + str(image_path))
+            last_size = size
+            time.sleep(FILE_SETTLE_TIME)
+
+    def run(self):
+        for _ in range(self.num_slices):
+            image_slice = self.q.get()
+            if image_slice is self._STOP:
+                return
+            if image_slice is None:
+                continue
+            try:
+                key = None
+                image_path = None
+                if not isinstance(image_slice, np.ndarray):
+                    image_path = image_slice
+                    key = slice_key(image_slice)
+                    image_slice = self._load(image_slice)
+                    if image_slice.ndim == 3 and image_slice.shape[2] == 4:
+                        image_slice = image_slice[:, :, :3]
+                self.stacker.add(image_slice, key=key)
+                self.fused_paths.append(image_path)
+            except (IOError, cv2.error) as e:
+                print("Skipping slice of", Path(self.output_path).name, ":", e)
+
+    def finish(self):
+        """
+        Waits for the remaining slices and writes the fused image
+        :return: output_path, or None if no slice could be fused
+        """
+        self.join()
+        fused = self.stacker.result()
+        if fused is None:
+            return None
+        cv2.imwrite(str(self.output_path), fused)
+        print("Stacked image saved as", self.output_path)
+        if self.depth_map:
+            save_depth_map(self.stacker.depth(), self.output_path, self.fused_paths)
+        else:
+            remove_depth_map(self.output_path)
+        return self.output_path
+
+
+def stack_focus_streaming(image_paths, output_path, align=True, alignment_cache=None, align_settings=None,
+                          depth_map=False):
+    """
+    Fuses the given slices one at a time from disk (constant memory in stack depth) and writes the result
+    :param align_settings: dict of max_size, align_levels and align_eps passed to the alignment (optional)
+    :param depth_map: also write the slice index map (see save_depth_map)
+    :return: output_path
+    """
+    stacker = StreamingStacker(align=align, alignment_cache=alignment_cache, **(align_settings or {}))
+    for image_path in image_paths:
+        stacker.add_path(image_path)
+    cv2.imwrite(str(output_path), stacker.result())
+    if depth_map:
+        save_depth_map(stacker.depth(), output_path, image_paths)
+
+    return output_path
+
+
+def tile_size_for_budget(num_slices, channels, itemsize, memory_budget=TILED_MEMORY_BUDGET, levels=TILE_LEVELS):
+    """
+    :param memory_budget: peak memory in MB available for fusing a tile (all slices of the tile incl. its halo plus
+                          the working memory of the pyramid fusion)
+    :return: largest tile side (a multiple of 2 ** levels, so tiles share the pyramid sampling grid) within budget
+    """
+    step = 2 ** levels
+    halo = TILE_HALO_FACTOR * step
+    bytes_per_pixel = num_slices * channels * itemsize + FUSE_BYTES_PER_PIXEL * channels + 16
+    side = int(np.sqrt(memory_budget * 2 ** 20 / bytes_per_pixel)) - 2 * halo
+    return max(side // step * step, step)
+
+
+def tile_boxes(shape, tile_size, halo):
+    """
+    :return: list of (core, padded) boxes (y0, y1, x0, x1) covering an image of the given shape. The cores do not
+             overlap, the padded boxes extend them by the halo (clipped to the image).
+    """
+    height, width = shape[:2]
+    boxes = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            core = (y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width))
+            padded = (max(core[0] - halo, 0), min(core[1] + halo, height),
+                      max(core[2] - halo, 0), min(core[3] + halo, width))
+            boxes.append((core, padded))
+    return boxes
+
+
+def fuse_tile(slices, core, padded, levels=TILE_LEVELS):
+    """
+    Fuses one tile of a stack of aligned slices
+    :param slices: array (or memory map) of all aligned slices, shape (slices, height, width[, channels])
+    :return: fused core region of the tile and its slice index map
+    """
+    tile_slices = list(np.asarray(slices[:, padded[0]:padded[1], padded[2]:padded[3]]))
+    fused, index = fuse_stack(tile_slices, levels=levels, return_index=True)
+    crop = (slice(core[0] - padded[0], core[1] - padded[0]), slice(core[2] - padded[2], core[3] - padded[2]))
+    return fused[crop], index[crop]
+
+
+def fuse_tile_to_file(slices_path, fused_path, depth_path, core, padded, levels=TILE_LEVELS):
+    """
+    Process pool task: fuses one tile of the memory mapped slices into the memory mapped result (and depth map)
+    """
+    slices = np.load(slices_path, mmap_mode="r")
+    fused = np.load(fused_path, mmap_mode="r+")
+    fused_tile, index_tile = fuse_tile(slices, core, padded, levels)
+    fused[core[0]:core[1], core[2]:core[3]] = fused_tile
+    fused.flush()
+    if depth_path is not None:
+        depth = np.load(depth_path, mmap_mode="r+")
+        depth[core[0]:core[1], core[2]:core[3]] = index_tile
+        depth.flush()
+    return core
+
+
+def _init_tile_worker():
+    # the tile pool already keeps every core busy, a worker's own OpenCV threads would oversubscribe them
+    cv2.setNumThreads(1)
+
+
+_tile_pool = None
+_tile_pool_lock = threading.Lock()
+
+
+def get_tile_pool(num_workers):
+    """
+    Returns the process pool used to fuse tiles, shared by all stacks that are processed concurrently
+    """
+    global _tile_pool
+    with _tile_pool_lock:
+        if _tile_pool is None:
+            _tile_pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_tile_worker)
+        return _tile_pool
+
+
+def write_aligned_slices(image_paths, slices_path, align=True, alignment_cache=None, align_settings=None):
+    """
+    Aligns the slices one at a time and writes them to a memory mapped .npy file
+    :return: read-only memory map of the aligned slices, shape (slices, height, width[, channels])
+    """
+    align_settings = align_settings or {}
+    keys = [slice_key(image_path) for image_path in image_paths]
+
+    image = load_image(image_paths[0])
+    slices = np.lib.format.open_memmap(str(slices_path), mode="w+", dtype=image.dtype,
+                                       shape=(len(image_paths),) + image.shape)
+    slices[0] = image
+    previous_gray = to_gray(image)
+    transform = np.eye(2, 3, dtype=np.float32)
+    for i in range(1, len(image_paths)):
+        image = load_image(image_paths[i])
+        if align:
+            gray = to_gray(image)
+            step = estimate_step(previous_gray, gray, key=pair_key(keys[i - 1], keys[i]),
+                                 alignment_cache=alignment_cache, **align_settings)
+            transform = compose(transform, step)
+            image = warp_image(image, transform)
+            previous_gray = gray
+        slices[i] = image
+    slices.flush()
+    del slices
+
+    if alignment_cache is not None:
+        alignment_cache.save()
+
+    return np.load(str(slices_path), mmap_mode="r")
+
+
+def stack_focus_tiled(image_paths, output_path, scratch_folder, memory_budget=TILED_MEMORY_BUDGET, align=True,
+                      levels=TILE_LEVELS, alignment_cache=None, align_settings=None, num_workers=1, depth_map=False):
+    """
+    Out-of-core variant of stack_focus: the aligned slices are written to a memory map in scratch_folder (one slice
+    in memory at a time) and fused in overlapping tiles whose size is chosen to stay within memory_budget MB
+    :param scratch_folder: folder for the memory maps, should be on disk rather than in RAM
+    :param num_workers: maximum number of processes fusing tiles in parallel, the memory budget is shared between
+                        them (fewer are used if the tiles would otherwise be smaller than TILE_MIN_SIZE_HALOS halos)
+    :param depth_map: also write the slice index map (see save_depth_map)
+    :return: output_path
+    """
+    name = Path(output_path).stem
+    slices_path = Path(scratch_folder).joinpath(name + "_slices.npy")
+    fused_path = Path(scratch_folder).joinpath(name + "_fused.npy")
+    depth_path = Path(scratch_folder).joinpath(name + "_depth.npy")
+    slices = None
+    fused = None
+    depth = None
+    try:
+        print("Aligning", len(image_paths), "images of", Path(output_path).name, "into", slices_path)
+        slices = write_aligned_slices(image_paths, slices_path, align=align, alignment_cache=alignment_cache,
+                                      align_settings=align_settings)
+
+        channels = slices.shape[3] if slices.ndim == 4 else 1
+        step = 2 ** levels
+        halo = TILE_HALO_FACTOR * step
+        min_tile_size = TILE_MIN_SIZE_HALOS * halo
+        pool_workers = num_workers
+        # the workers share the memory budget, so every additional worker shrinks the tiles: only use as many as
+        # leave at least two tiles of min_tile_size per worker, each within its share of the budget
+        num_workers = max(min(num_workers, int(slices.shape[1] * slices.shape[2] / (2.0 * min_tile_size ** 2))), 1)
+        while num_workers > 1 and tile_size_for_budget(len(slices), channels, slices.dtype.itemsize,
+                                                       memory_budget / num_workers, levels) < min_tile_size:
+            num_workers -= 1
+        tile_size = tile_size_for_budget(len(slices), channels, slices.dtype.itemsize, memory_budget / num_workers,
+                                         levels)
+        if num_workers > 1:
+            # at least two tiles per worker, so no worker idles while the others finish large tiles
+            even_size = int(np.sqrt(slices.shape[1] * slices.shape[2] / (2.0 * num_workers))) // step * step
+            tile_size = max(min(tile_size, even_size), min_tile_size)
+        boxes = tile_boxes(slices.shape[1:3], tile_size, halo)
+        print("Fusing", len(slices), "images of", Path(output_path).name, "in", len(boxes), "tiles of",
+              tile_size, "px using", num_workers, "processes")
+
+        fused = np.lib.format.open_memmap(str(fused_path), mode="w+", dtype=slices.dtype, shape=slices.shape[1:])
+        if depth_map:
+            depth = np.lib.format.open_memmap(str(depth_path), mode="w+", dtype=np.uint16, shape=slices.shape[1:3])
+        if num_workers > 1:
+            # the workers open the memory maps themselves and write their tiles straight into the result
+            fused.flush()
+            fused = None
+            if depth is not None:
+                depth.flush()
+                depth = None
+            # the shared pool may have more processes than this stack uses, so at most num_workers tiles (the ones
+            # the budget was split between) are submitted at a time
+            pool = get_tile_pool(pool_workers)
+            jobs = set()
+            for core, padded in boxes:
+                if len(jobs) >= num_workers:
+                    done, jobs = wait(jobs, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        job.result()
+                jobs.add(pool.submit(fuse_tile_to_file, str(slices_path), str(fused_path),
+                                     str(depth_path) if depth_map else None, core, padded, levels))
+            for job in jobs:
+                job.result()
+            fused = np.load(str(fused_path), mmap_mode="r")
+            if depth_map:
+                depth = np.load(str(depth_path), mmap_mode="r")
+        else:
+            for core, padded in boxes:
+                fused_tile, index_tile = fuse_tile(slices, core, padded, levels)
+                fused[core[0]:core[1], core[2]:core[3]] = fused_tile
+                if depth is not None:
+                    depth[core[0]:core[1], core[2]:core[3]] = index_tile
+            fused.flush()
+        cv2.imwrite(str(output_path), fused)
+        if depth is not None:
+            save_depth_map(depth, output_path, image_paths)
+    finally:
+        # memory maps have to be closed before their files can be removed (Windows)
+        slices = None
+        fused = None
+        depth = None
+        for path in (slices_path, fused_path, depth_path):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    return output_path
@@ -0,0 +1,102 @@
+import os
+import re
+from pathlib import Path
+
+"""
+Frame index
+
+Parses the scAnt frame names (_x_#####_y_#####_step_#####_.ext) once into integer (x, y, z) keys, so frames can be
+grouped into stacks (all focus steps of one view), views (x, y) and rotations (all y positions of one x position)
+in a single pass, in numerical rather than string order.
+
+    index = FrameIndex.from_folder(project.joinpath("RAW"))
+    for stack_name, frame_paths in index.stacks(min_frames=2):
+        ...
+"""
+
+FRAME_NAME_PATTERN = re.compile(r"_x_(\d+)_y_(\d+)_step_(\d+)_")
+
+
+def parse_frame_name(frame_path):
+    """
+    :param frame_path: path or name of a frame, e.g. "_x_00050_y_00080_step_08000_.tif"
+    :return: tuple of the stack name ("_x_00050_y_00080_") and the integer (x, y, z) position,
+             or (None, None) if the name does not follow the scAnt naming convention
+    """
+    name = Path(str(frame_path)).name
+    match = FRAME_NAME_PATTERN.search(name)
+    if match is None:
+        return None, None
+    stack_name = name[:match.start(3) - len("step_")]
+    return stack_name, (int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+def stack_name_of(frame_path):
+    """
+    :return: name of the stack a frame belongs to ("_x_00050_y_00080_"), or None for unknown names
+    """
+    return parse_frame_name(frame_path)[0]
+
+
+class FrameIndex:
+
+    def __init__(self, frame_paths=()):
+        # (x, y) -> [stack name, [(z, frame path), ...]]
+        self.views_by_pos = {}
+        # frames that do not follow the naming convention
+        self.unparsed = []
+
+        for frame_path in frame_paths:
+            self.add(frame_path)
+
+    @classmethod
+    def from_folder(cls, folder, extensions=(".tif", ".tiff", ".jpg", ".jpeg", ".png", ".cr2", ".nef")):
+        """
+        Indexes all frames in a folder (usually the project's RAW folder)
+        """
+        folder = Path(folder)
+        return cls(folder.joinpath(name) for name in os.listdir(folder)
+                   if name.lower().endswith(tuple(extensions)))
+
+    def add(self, frame_path):
+        stack_name, pos = parse_frame_name(frame_path)
+        if pos is None:
+            self.unparsed.append(frame_path)
+            return
+        view = self.views_by_pos.setdefault(pos[:2], [stack_name, []])
+        view[1].append((pos[2], frame_path))
+
+    def __len__(self):
+        return sum(len(frames) for _, frames in self.views_by_pos.values())
+
+    def views(self):
+        """
+        :return: sorted list of all (x, y) positions
+        """
+        return sorted(self.views_by_pos)
+
+    def rotations(self):
+        """
+        :return: dict of x position -> sorted list of y positions captured at that x position
+        """
+        rotations = {}
+        for x, y in self.views():
+            rotations.setdefault(x, []).append(y)
+        return rotations
+
+    def stacks(self, min_frames=1, furthest_first=True):
+        """
+        :param min_frames: stacks with fewer frames are left out
+        :param furthest_first: order the frames of each stack by descending focus step, starting with the frame
+                               furthest away (maximises the field of view during alignment and leads to better
+                               blending results with less ghosting)
+        :return: list of (stack name, list of frame paths), ordered by (x, y)
+        """
+        stacks = []
+        for pos in self.views():
+            stack_name, frames = self.views_by_pos[pos]
+            if len(frames) < min_frames:
+                continue
+            frames = sorted(frames, key=lambda frame: frame[0], reverse=furthest_first)
+            stacks.append((stack_name, [frame_path for _, frame_path in frames]))
+        return stacks
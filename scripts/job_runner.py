@@ -0,0 +1,203 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Job runner for external tools (align_image_stack, enfuse, focus-stack, exiftool, ticcmd)
+
+Runs programs from argument lists (no shell), with a timeout per job, captured output, a retry policy and a limit
+on how many jobs of a runner may run at the same time. Running jobs can be cancelled, e.g. when a scan is aborted
+or the application is closed.
+
+    runner = JobRunner(max_concurrent=2)
+    result = runner.run(["enfuse", "--output=out.tif", "a.tif", "b.tif"], timeout=600, check=True)
+    print(result.returncode, result.stderr)
+"""
+
+
+def get_num_workers():
+    """
+    Returns the number of cores this process is allowed to run on, used to size thread / process pools and the
+    number of concurrent jobs
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return max(os.cpu_count() or 1, 1)
+
+
+# seconds to wait for the output of a killed job, in case its pipes are held open by a process that survived
+KILL_TIMEOUT = 10
+
+# every job runs in its own process group, so a program started through a wrapper (shell / batch script, conda
+# shim) is killed together with the wrapper
+if os.name == "nt":
+    PROCESS_GROUP_ARGS = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    PROCESS_GROUP_ARGS = {"start_new_session": True}
+
+
+def kill_process_tree(process):
+    """
+    Kills a job and all processes it started
+    """
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.kill()
+
+
+class JobError(Exception):
+    """ Raised by JobRunner.run(check=True) if a job failed, timed out or was cancelled """
+
+    def __init__(self, result):
+        self.result = result
+        Exception.__init__(self, str(result))
+
+
+class JobResult:
+
+    def __init__(self, args, returncode, stdout, stderr, duration, attempts, timed_out=False, cancelled=False,
+                 launch_failed=False):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.attempts = attempts
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        # the program could not be started (not found / not executable), retrying would fail the same way
+        self.launch_failed = launch_failed
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    def __str__(self):
+        if self.cancelled:
+            state = "cancelled"
+        elif self.launch_failed:
+            state = "could not be started"
+        elif self.timed_out:
+            state = "timed out after %.1f s" % self.duration
+        else:
+            state = "exit code " + str(self.returncode)
+        text = " ".join(self.args) + " (" + state + ", " + str(self.attempts) + " attempt(s))"
+        if not self.ok and self.stderr:
+            text += "\n" + self.stderr.strip()
+        return text
+
+
+class JobRunner:
+
+    def __init__(self, max_concurrent=1, timeout=None, retries=0, retry_delay=1.0):
+        """
+        :param max_concurrent: number of jobs that may run at the same time, further jobs wait for a free slot
+        :param timeout: default timeout of each attempt in seconds (None to wait indefinitely)
+        :param retries: default number of additional attempts after a failed or timed out attempt (programs that
+                        cannot be started at all are not retried)
+        :param retry_delay: seconds to wait between attempts
+        """
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.running = set()
+        self.running_lock = threading.Lock()
+        self.cancelled = False
+        self.executor = None
+
+    def run(self, args, timeout=None, retries=None, check=False):
+        """
+        Runs a program and waits for it to finish
+        :param args: list of the program and its arguments
+        :param timeout: timeout of each attempt in seconds, uses the runner's default if None
+        :param retries: number of additional attempts, uses the runner's default if None
+        :param check: raise JobError if the job did not succeed
+        :return: JobResult
+        """
+        args = [str(arg) for arg in args]
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.retries
+
+        start = time.time()
+        result = None
+        with self.slots:
+            for attempt in range(1, retries + 2):
+                if self.cancelled:
+                    result = JobResult(args, None, "", "", time.time() - start, attempt - 1, cancelled=True)
+                    break
+                result = self._run_once(args, timeout, attempt, start)
+                if result.ok or result.cancelled or result.launch_failed:
+                    break
+                if attempt <= retries:
+                    print("Retrying", args[0], "after failed attempt", attempt, ":", result)
+                    time.sleep(self.retry_delay)
+
+        if check and not result.ok:
+            raise JobError(result)
+        return result
+
+    def _run_once(self, args, timeout, attempt, start):
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       universal_newlines=True, **PROCESS_GROUP_ARGS)
+        except OSError as e:
+            # program not found / not executable
+            return JobResult(args, None, "", str(e), time.time() - start, attempt, launch_failed=True)
+
+        with self.running_lock:
+            self.running.add(process)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+            timed_out = False
+        except subprocess.TimeoutExpired:
+            kill_process_tree(process)
+            try:
+                stdout, stderr = process.communicate(timeout=KILL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                stdout, stderr = "", ""
+            timed_out = True
+        finally:
+            with self.running_lock:
+                self.running.discard(process)
+
+        return JobResult(args, process.returncode, stdout, stderr, time.time() - start, attempt,
+                         timed_out=timed_out, cancelled=self.cancelled)
+
+    def submit(self, args, timeout=None, retries=None, check=False):
+        """
+        Runs a program in the background
+        :return: concurrent.futures.Future of the JobResult
+        """
+        with self.running_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        return self.executor.submit(self.run, args, timeout=timeout, retries=retries, check=check)
+
+    def cancel_all(self):
+        """
+        Kills all running jobs and rejects jobs that are still waiting for a slot
+        """
+        self.cancelled = True
+        with self.running_lock:
+            for process in self.running:
+                kill_process_tree(process)
+
+    def reset(self):
+        """
+        Accepts new jobs again after cancel_all()
+        """
+        self.cancelled = False
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+try:
+    from scripts.sidecar import JsonSidecar, get_shared
+except ModuleNotFoundError:
+    from sidecar import JsonSidecar, get_shared
+
+"""
+Post-processing manifest
+
+Records for every stack and mask of a project which inputs it was produced from, a hash of the parameters used and
+which files it produced (postprocessing_manifest.json in the project folder). Re-running the post-processing only
+redoes work whose inputs or parameters changed, or whose outputs are missing, so an interrupted run resumes where
+it stopped.
+
+{
+    "stacks": {
+        "_x_00000_y_00000_": {
+            "inputs": {"RAW/_x_00000_y_00000_step_08000_.tif": [15040938, 1601234567890123456], ...},
+            "params": "5f1d...",
+            "outputs": ["stacked/_x_00000_y_00000_.tif"]
+        },
+        ...
+    },
+    "masks": {...}
+}
+"""
+
+MANIFEST_NAME = "postprocessing_manifest.json"
+
+
+def params_hash(params, keys):
+    """
+    :param params: dict of processing parameters
+    :param keys: names of the parameters that affect the result of a stage
+    :return: hash of the values of the given parameters
+    """
+    relevant = {key: params.get(key) for key in keys}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Manifest(JsonSidecar):
+    description = "manifest"
+
+    def __init__(self, manifest_path):
+        self.stages = {}
+        JsonSidecar.__init__(self, manifest_path)
+
+    def from_json(self, content):
+        self.stages = content
+
+    def to_json(self):
+        return self.stages
+
+    def file_inputs(self, paths):
+        """
+        :return: dict of relative path -> [size, modification time] of the given files
+        """
+        inputs = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                inputs[self._key(path)] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                inputs[self._key(path)] = None
+        return inputs
+
+    def fingerprint(self, stage, name):
+        """
+        :return: hash of the recorded inputs and parameters of an entry, or None if it is not recorded. Later
+                 stages can use this as their input, so rewriting an output (e.g. adding exif data) does not
+                 invalidate them.
+        """
+        with self.lock:
+            entry = self.stages.get(stage, {}).get(name)
+        if entry is None:
+            return None
+        return hashlib.sha1(json.dumps([entry["inputs"], entry["params"]], sort_keys=True).encode()).hexdigest()
+
+    def is_current(self, stage, name, inputs, params_digest):
+        """
+        :return: True if the entry was produced from the same inputs and parameters and all its outputs exist
+        """
+        with self.lock:
+            entry = self.stages.get(stage, {}).get(name)
+        if entry is None or entry["inputs"] != inputs or entry["params"] != params_digest:
+            return False
+        return all(self.root.joinpath(output).is_file() for output in entry["outputs"])
+
+    def record(self, stage, name, inputs, params_digest, outputs):
+        with self.lock:
+            self.stages.setdefault(stage, {})[name] = {"inputs": inputs,
+                                                       "params": params_digest,
+                                                       "outputs": [self._key(output) for output in outputs]}
+            self.changed = True
+
+
+def get_manifest(project_folder):
+    """
+    Returns the shared Manifest of the given project folder, loading it on first use
+    """
+    return get_shared(Manifest, Path(project_folder).joinpath(MANIFEST_NAME))
@@ -27,6 +27,9 @@ compression:
 stack_images:
 stacking_method:
 threshold:
+focus_mode:
+focus_fraction:
+depth_map:
 display_focus_check:
 additional_sharpening
 
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+"""
+JSON sidecar files
+
+Base class of the files that keep results of a project between runs (focus_scores.json, alignment_transforms.json,
+postprocessing_manifest.json, artifact_cache/file_hashes.json). Every file is loaded once per process and shared
+by all threads (get_shared). Changes are kept in memory and written with save(), first to a temporary file that
+then replaces the sidecar, so an interrupted run never leaves a corrupted file behind.
+
+Subclasses set up their content before calling JsonSidecar.__init__ (which loads the file) and implement
+from_json() and to_json().
+"""
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class JsonSidecar:
+    # name of the file in messages
+    description = "sidecar file"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.root = self.path.parent
+        self.changed = False
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def from_json(self, content):
+        """
+        Takes over the content read from the file
+        """
+        raise NotImplementedError
+
+    def to_json(self):
+        """
+        :return: content to write to the file, called while holding the lock
+        """
+        raise NotImplementedError
+
+    def load(self):
+        if not self.path.is_file():
+            return
+
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read", self.description, self.path, ":", e)
+            return
+        self.from_json(content)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            content = json.dumps(self.to_json())
+            self.changed = False
+
+            os.makedirs(self.path.parent, exist_ok=True)
+            temp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(temp_path, "w") as f:
+                f.write(content)
+            os.replace(temp_path, self.path)
+
+    def _key(self, path):
+        """
+        :return: path relative to the folder of the sidecar, so the project folder can be moved
+        """
+        try:
+            return Path(os.path.relpath(path, self.root)).as_posix()
+        except ValueError:
+            # files on a different drive than the sidecar (Windows)
+            return Path(path).as_posix()
+
+
+def get_shared(sidecar_class, path, create=None, is_current=None):
+    """
+    Returns the shared instance of a sidecar class for the given path, loading it on first use
+    :param create: function(path) creating a new instance, sidecar_class(path) by default
+    :param is_current: function(instance), an instance for which it returns False is replaced by a new one
+    """
+    path = Path(path).resolve()
+    with _shared_lock:
+        instance = _shared.get((sidecar_class, path))
+        if instance is None or (is_current is not None and not is_current(instance)):
+            instance = create(path) if create is not None else sidecar_class(path)
+            _shared[(sidecar_class, path)] = instance
+    return instance
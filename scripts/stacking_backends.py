@@ -0,0 +1,125 @@
+import json
+from pathlib import Path
+
+"""
+Stacking backend registry
+
+Every way of turning a stack of frames into a single all-in-focus image (hugin + enfuse, focus-stack, the in-process
+engines of scripts/focus_stacking.py) is registered as a StackingBackend with an availability probe, so the
+stacking method can be chosen per machine instead of per platform:
+
+    default:    the previous behaviour (focus-stack under Windows if use_experimental_stacking is set, hugin + enfuse
+                otherwise), falling back to the next available backend if the external tools are missing
+    auto:       the fastest available backend according to a benchmark report (benchmark_stacking.json, see
+                scripts/benchmark_stacking.py), or the first available backend in order of registration
+    <name>:     a specific backend, e.g. "focus-stack" or "tiled"
+"""
+
+BENCHMARK_REPORT_NAME = "benchmark_stacking.json"
+
+_backends = {}
+
+
+class StackingBackend:
+
+    def __init__(self, name, stack, probe=None, in_process=False, depth_map=False, description=""):
+        """
+        :param name: name used for the stacking_method setting
+        :param stack: function(image_paths, output_path, output_folder, path_to_external, params) writing the fused
+                      image to output_path
+        :param probe: function(path_to_external) returning True if the backend can run on this machine
+        :param in_process: True if the backend does not depend on external programs
+        :param depth_map: True if the backend can write a depth map (params["depth_map"])
+        """
+        self.name = name
+        self.stack = stack
+        self.probe = probe
+        self.in_process = in_process
+        self.depth_map = depth_map
+        self.description = description
+        self.probed = {}
+
+    def available(self, path_to_external=None):
+        if self.probe is None:
+            return True
+        key = str(path_to_external)
+        if key not in self.probed:
+            self.probed[key] = bool(self.probe(path_to_external))
+        return self.probed[key]
+
+
+def register_backend(backend):
+    _backends[backend.name] = backend
+    return backend
+
+
+def get_backend(name):
+    return _backends[name]
+
+
+def backend_names():
+    return list(_backends)
+
+
+def available_backends(path_to_external=None):
+    return [backend for backend in _backends.values() if backend.available(path_to_external)]
+
+
+def load_benchmark_timings(report_paths):
+    """
+    :param report_paths: benchmark reports to read, earlier reports take precedence
+    :return: dict of backend name -> megapixel slices per second
+    """
+    timings = {}
+    for report_path in reversed([Path(path) for path in report_paths]):
+        if not report_path.is_file():
+            continue
+        try:
+            with open(report_path) as f:
+                report = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read benchmark report", report_path, ":", e)
+            continue
+        for name, result in report.get("methods", {}).items():
+            if result.get("available") and result.get("megapixel_slices_per_second"):
+                timings[name] = result["megapixel_slices_per_second"]
+    return timings
+
+
+def select_backend(method, path_to_external=None, default_order=(), benchmark_reports=(), depth_map=False):
+    """
+    :param method: "default", "auto" or the name of a backend
+    :param default_order: backend names tried in order for "default"
+    :param benchmark_reports: paths of benchmark reports used by "auto"
+    :param depth_map: a depth map is requested, "auto" only picks backends that can write one
+    :return: StackingBackend
+    """
+    candidates = available_backends(path_to_external)
+    if not candidates:
+        raise RuntimeError("No stacking backend is available")
+
+    if method == "auto":
+        if depth_map and any(backend.depth_map for backend in candidates):
+            candidates = [backend for backend in candidates if backend.depth_map]
+        timings = load_benchmark_timings(benchmark_reports)
+        timed = [backend for backend in candidates if backend.name in timings]
+        if timed:
+            return max(timed, key=lambda backend: timings[backend.name])
+        return candidates[0]
+
+    if method == "default":
+        order = list(default_order)
+    else:
+        if method not in _backends:
+            raise ValueError("Unknown stacking method " + str(method) + ", expected one of " +
+                             ", ".join(["default", "auto"] + backend_names()))
+        order = [method] + list(default_order)
+
+    for name in order:
+        backend = _backends.get(name)
+        if backend is not None and backend in candidates:
+            if name != order[0]:
+                print(order[0], "is not available, stacking with", name, "instead")
+            return backend
+    print(order[0] if order else method, "is not available, stacking with", candidates[0].name, "instead")
+    return candidates[0]
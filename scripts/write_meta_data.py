@@ -1,13 +1,19 @@
-import subprocess
 import time
 from pathlib import Path
 import platform
 try:
     from scripts.project_manager import read_config_file
+    from scripts.job_runner import JobRunner, get_num_workers
 except ModuleNotFoundError:
     from project_manager import read_config_file
+    from job_runner import JobRunner, get_num_workers
 import os
 
+EXIFTOOL_TIMEOUT = 60
+
+# exif data is written in the background while scanning / stacking continues
+exif_jobs = JobRunner(max_concurrent=get_num_workers(), timeout=EXIFTOOL_TIMEOUT, retries=1)
+
 
 # follow installation guide for Ubuntu or use executable directly under Windows (located in "/external")
 # sudo apt install libimage-exiftool-perl
@@ -21,10 +27,11 @@ def show_me_what_you_got(img_path):
 
     infoDict = {}  # Creating the dict to get the metadata tags
     ''' use Exif tool to get the metadata '''
-    process = subprocess.Popen([exifToolPath, img_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                               universal_newlines=True)
+    result = exif_jobs.run([exifToolPath, img_path])
+    if not result.ok:
+        print("Could not read metadata:", result)
     """ get the tags in dict """
-    for tag in process.stdout:
+    for tag in result.stdout.splitlines():
         line = tag.strip().split(':')
         infoDict[line[0].strip()] = line[-1].strip()
 
@@ -49,7 +56,15 @@ def write_exif_to_img(img_path, custom_exif_dict):
 
     print(complete_command)
 
-    subprocess.Popen(complete_command)
+    job = exif_jobs.submit(complete_command)
+    job.add_done_callback(_report_exif_job)
+    return job
+
+
+def _report_exif_job(job):
+    result = job.result()
+    if not result.ok:
+        print("Could not write metadata:", result)
 
 
 def get_default_values():